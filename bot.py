@@ -9,156 +9,301 @@ Features:
 - Sends all messages inside a specific topic/thread (set via TOPIC_ID)
 - Uses webhook mode for deployment (Render-friendly)
 - Logs all user interactions
+- Keeps active sleep sessions in Redis (REDIS_URL), shared across workers
 - Adjusted sleep classification: 06:00–18:00 → day; otherwise → night
 """
 
 import os
+import json
+import time
+import queue
+import atexit
+import asyncio
 import logging
-from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+import orjson
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-from flask import Flask, request
+from redis.asyncio import Redis
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
 )
-import pytz
+from telegram.request import HTTPXRequest
 
 # --- Setup ---
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("https://telegram-bot-i0eq.onrender.com")
+WEBHOOK_SECRET = os.environ["WEBHOOK_SECRET"]  # required: checked against X-Telegram-Bot-Api-Secret-Token
+REDIS_URL = os.environ["REDIS_URL"]  # required: sleep sessions live in Redis
 TOPIC_ID = 4  # your topic/thread ID inside the group
-BERLIN_TZ = pytz.timezone("Europe/Berlin")
+TZ_NAME = "Europe/Berlin"
+BERLIN_TZ = ZoneInfo(TZ_NAME)
 
 # --- Logging ---
-logging.basicConfig(
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    level=logging.INFO,
-)
+# Log calls only enqueue records; a listener thread does the actual writes
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # --- State storage ---
-user_sleep_data = {}  # {user_id: datetime_start}
+sleep_store = Redis.from_url(REDIS_URL)  # sleep:{user_id} -> ISO start time
+SLEEP_TTL = 18 * 3600  # drop sessions nobody stopped after 18h
 
 
-# --- Buttons ---
-def main_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("😴 Start sleep", callback_data="start_sleep")]
-    ])
+def sleep_key(user_id: int) -> str:
+    return f"sleep:{user_id}"
+
+
+# --- Outbound queue ---
+_out_q: asyncio.Queue = asyncio.Queue()  # (send_message kwargs, coalesce)
+OUT_WORKERS = 16  # concurrent senders, so throughput isn't capped at 1/RTT
+# Messages sent or edited per second by this process. Callback answers are
+# not gated, and each worker process has its own budget.
+OUT_RATE = 30
+OUT_LIMITER = AsyncLimiter(OUT_RATE, 1)
+COALESCE_WINDOW = 1.0  # seconds; identical coalesced sends inside it are dropped
+_last_sent = {}  # {(chat_id, thread_id, text): monotonic time}, last COALESCE_WINDOW only
+_coalesce_lock = asyncio.Lock()  # duplicates wait for the first send's outcome
+
+
+def send_later(coalesce: bool = False, **kwargs) -> None:
+    """Queue a bot.send_message call for the rate-limited outbound workers.
 
+    With coalesce=True, an identical message to the same chat/topic already
+    delivered within COALESCE_WINDOW is dropped.
+    """
+    _out_q.put_nowait((kwargs, coalesce))
 
-def sleep_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🛑 Stop sleep", callback_data="stop_sleep")],
-        [InlineKeyboardButton("❌ Cancel", callback_data="cancel_sleep")]
-    ])
+
+async def _send(bot, kwargs: dict, coalesce: bool) -> None:
+    if not coalesce:
+        async with OUT_LIMITER:
+            await bot.send_message(**kwargs)
+        return
+
+    key = (kwargs["chat_id"], kwargs.get("message_thread_id"), kwargs["text"])
+    async with _coalesce_lock:
+        now = time.monotonic()
+        for stale in [k for k, t in _last_sent.items() if now - t >= COALESCE_WINDOW]:
+            del _last_sent[stale]
+        if key in _last_sent:
+            return
+        async with OUT_LIMITER:
+            await bot.send_message(**kwargs)
+        # Only a delivered message suppresses its duplicates
+        _last_sent[key] = time.monotonic()
+
+
+async def outbound_worker(bot) -> None:
+    while True:
+        kwargs, coalesce = await _out_q.get()
+        try:
+            await _send(bot, kwargs, coalesce)
+        except RetryAfter as exc:
+            delay = exc.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            logger.warning(f"Flood control hit, retrying send in {delay}s")
+            await asyncio.sleep(delay)
+            _out_q.put_nowait((kwargs, coalesce))
+        except TelegramError as exc:
+            logger.error(f"Outbound send_message failed: {exc}")
+        except Exception:
+            # Keep the worker alive: one bad item must not stall all sends
+            logger.exception("Outbound send_message crashed")
+        finally:
+            _out_q.task_done()
+
+
+# --- Buttons ---
+MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("😴 Start sleep", callback_data="start_sleep")]
+])
+
+SLEEP_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛑 Stop sleep", callback_data="stop_sleep")],
+    [InlineKeyboardButton("❌ Cancel", callback_data="cancel_sleep")]
+])
 
 
 # --- Helpers ---
-def get_sleep_type(start_time: datetime) -> str:
-    """Return 'day' or 'night' based on start time hour."""
-    hour = start_time.hour
-    if 6 <= hour < 18:
-        return "day"
-    else:
-        return "night"
+@lru_cache(maxsize=256)
+def _fmt_hhmm(epoch_minute: int, tz_name: str) -> str:
+    """Format a minute-resolution timestamp as local HH:MM (cached per minute)."""
+    return datetime.fromtimestamp(epoch_minute * 60, ZoneInfo(tz_name)).strftime("%H:%M")
+
+
+def fmt_hhmm(dt: datetime) -> str:
+    return _fmt_hhmm(int(dt.timestamp()) // 60, TZ_NAME)
+
+
+# Sleep type and emoji indexed by start hour: 06:00–18:00 → day; otherwise → night
+_SLEEP_TYPE = ["night"] * 6 + ["day"] * 12 + ["night"] * 6
+_EMOJI = ["🌙"] * 6 + ["🌞"] * 12 + ["🌙"] * 6
 
 
 # --- Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     logger.info(f"{user.first_name} ({user.id}) used /start")
-    await context.bot.send_message(
+    send_later(
         chat_id=update.effective_chat.id,
         message_thread_id=TOPIC_ID,
         text="Welcome to Sleep Tracker 😴\nPress start when you go to sleep:",
-        reply_markup=main_menu()
+        reply_markup=MAIN_MENU
     )
 
 
-async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def start_sleep(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user = query.from_user
-    user_id = user.id
     await query.answer()
 
-    # --- Start sleep ---
-    if query.data == "start_sleep":
-        user_sleep_data[user_id] = datetime.now(BERLIN_TZ)
-        start_time = user_sleep_data[user_id].strftime("%H:%M")
-        logger.info(f"{user.first_name} started sleeping at {start_time}")
+    now = datetime.now(BERLIN_TZ)
+    await sleep_store.set(sleep_key(user.id), now.isoformat(), ex=SLEEP_TTL)
+    start_time = fmt_hhmm(now)
+    logger.info(f"{user.first_name} started sleeping at {start_time}")
+    async with OUT_LIMITER:
         await query.edit_message_text(
             text=f"Sleep started at {start_time} 💤",
-            reply_markup=sleep_menu()
+            reply_markup=SLEEP_MENU
         )
 
-    # --- Stop sleep ---
-    elif query.data == "stop_sleep":
-        if user_id not in user_sleep_data:
+
+async def stop_sleep(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = query.from_user
+    await query.answer()
+
+    stored = await sleep_store.getdel(sleep_key(user.id))
+    if stored is None:
+        async with OUT_LIMITER:
             await query.edit_message_text(
                 "You haven’t started sleeping yet 😅",
-                reply_markup=main_menu()
+                reply_markup=MAIN_MENU
             )
-            logger.warning(f"{user.first_name} tried to stop sleep without starting")
-            return
+        logger.warning(f"{user.first_name} tried to stop sleep without starting")
+        return
 
-        start_time = user_sleep_data.pop(user_id)
-        end_time = datetime.now(BERLIN_TZ)
+    start_time = datetime.fromisoformat(stored.decode())
+    end_time = datetime.now(BERLIN_TZ)
 
-        duration = end_time - start_time
-        hours, remainder = divmod(duration.seconds, 3600)
-        minutes, _ = divmod(remainder, 60)
+    duration = end_time - start_time
+    hours, remainder = divmod(duration.seconds, 3600)
+    minutes, _ = divmod(remainder, 60)
 
-        start_str = start_time.strftime("%H:%M")
-        end_str = end_time.strftime("%H:%M")
-        duration_str = f"{hours}h {minutes}m"
+    start_str = fmt_hhmm(start_time)
+    end_str = fmt_hhmm(end_time)
+    duration_str = f"{hours}h {minutes}m"
 
-        sleep_type = get_sleep_type(start_time)
-        emoji = "🌞" if sleep_type == "day" else "🌙"
+    sleep_type = _SLEEP_TYPE[start_time.hour]
+    emoji = _EMOJI[start_time.hour]
 
-        logger.info(
-            f"{user.first_name} stopped sleeping at {end_str} ({duration_str}, {sleep_type})"
-        )
+    logger.info(
+        f"{user.first_name} stopped sleeping at {end_str} ({duration_str}, {sleep_type})"
+    )
 
+    async with OUT_LIMITER:
         await query.edit_message_text(
             text=f"{emoji} {sleep_type.capitalize()} sleep\n{start_str}–{end_str} ({duration_str})"
         )
 
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            message_thread_id=TOPIC_ID,
-            text="Ready for next nap? 😴",
-            reply_markup=main_menu()
-        )
+    send_later(
+        chat_id=update.effective_chat.id,
+        message_thread_id=TOPIC_ID,
+        text="Ready for next nap? 😴",
+        reply_markup=MAIN_MENU,
+        coalesce=True,
+    )
+
+
+async def cancel_sleep(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = query.from_user
+    await query.answer()
 
-    # --- Cancel sleep ---
-    elif query.data == "cancel_sleep":
-        user_sleep_data.pop(user_id, None)
-        logger.info(f"{user.first_name} canceled sleep tracking")
+    await sleep_store.delete(sleep_key(user.id))
+    logger.info(f"{user.first_name} canceled sleep tracking")
+    async with OUT_LIMITER:
         await query.edit_message_text(
             text="Sleep tracking canceled. Ready when you are 💤",
-            reply_markup=main_menu()
+            reply_markup=MAIN_MENU
         )
 
 
-# --- Flask Webhook ---
-flask_app = Flask(__name__)
+# --- Telegram Bot Setup ---
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            pass
+        # orjson rejects invalid UTF-8 and lone surrogates that PTB's
+        # stdlib path tolerates (e.g. echoed user text); fall back to it
+        try:
+            return json.loads(payload.decode("utf-8", "replace"))
+        except ValueError as exc:
+            raise TelegramError("Invalid server response") from exc
 
-@flask_app.route("/webhook", methods=["POST"])
-def webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    application.create_task(application.process_update(update))
-    return "OK", 200
 
+async def post_init(app: Application) -> None:
+    app.bot_data["outbound_workers"] = [
+        asyncio.create_task(outbound_worker(app.bot)) for _ in range(OUT_WORKERS)
+    ]
 
-# --- Telegram Bot Setup ---
-application = Application.builder().token(TOKEN).build()
+
+async def post_stop(app: Application) -> None:
+    # Flush queued messages before shutting down, but don't hang on it
+    try:
+        await asyncio.wait_for(_out_q.join(), timeout=5)
+    except asyncio.TimeoutError:
+        logger.warning(f"Dropping {_out_q.qsize()} queued outbound messages")
+    for task in app.bot_data["outbound_workers"]:
+        task.cancel()
+
+
+async def post_shutdown(app: Application) -> None:
+    await sleep_store.aclose()
+
+
+application = (
+    Application.builder()
+    .token(TOKEN)
+    .concurrent_updates(256)
+    .request(OrjsonRequest(
+        connection_pool_size=256,
+        http_version="2",
+        pool_timeout=5,
+        connect_timeout=5,
+        read_timeout=10,
+    ))
+    .post_init(post_init)
+    .post_stop(post_stop)
+    .post_shutdown(post_shutdown)
+    .build()
+)
 application.add_handler(CommandHandler("start", start))
-application.add_handler(CallbackQueryHandler(handle_buttons))
+application.add_handler(CallbackQueryHandler(start_sleep, pattern="^start_sleep$"))
+application.add_handler(CallbackQueryHandler(stop_sleep, pattern="^stop_sleep$"))
+application.add_handler(CallbackQueryHandler(cancel_sleep, pattern="^cancel_sleep$"))
 
 # --- Run Webhook ---
 if __name__ == "__main__":
@@ -168,5 +313,7 @@ if __name__ == "__main__":
         listen="0.0.0.0",
         port=int(os.environ.get("PORT", 8080)),
         url_path="webhook",
-        webhook_url=f"{WEBHOOK_URL}/webhook"
+        webhook_url=f"{WEBHOOK_URL}/webhook",
+        allowed_updates=["message", "callback_query"],
+        secret_token=WEBHOOK_SECRET,
     )